@@ -1,4 +1,5 @@
 # app.py
+import os
 import streamlit as st
 import pandas as pd
 from optimize import Optimizer
@@ -25,17 +26,49 @@ route optimization. Steps:
 week_start = st.text_input("Select week to optimize", value="2026-04-13")
 
 # --- Forecast caching to avoid reruns ---
-@st.cache_data
-def generate_forecast():
+# One full-horizon forecast serves every week; the Optimizer selects the week.
+# sales_stat is the (mtime, size) of INPUT_SALES: it keys the cache so an updated
+# file invalidates it, while the disk copy survives app restarts.
+# max_entries only bounds the in-memory layer (Streamlit never evicts disk pickles), so
+# entries for a superseded sales file are cleared explicitly when the file changes.
+@st.cache_data(persist="disk", max_entries=24)
+def generate_forecast(sales_stat):
     forecaster = Forecast(INPUT_SALES, HOLDOUT_WEEKS, FORECAST_HORIZON)
     return forecaster.run()
 
+@st.cache_resource
+def forecast_cache_state():
+    return {}  # process-wide: sales_stat last served by generate_forecast
+
+# --- Optimizer input caching: parse each spec CSV once per file version, not on every click ---
+# stat is file_stat(path), i.e. (mtime, size), so an edited CSV is re-read on the next click.
+def file_stat(path):
+    return (os.path.getmtime(path), os.path.getsize(path))
+
+@st.cache_data(max_entries=16)
+def load_csv(path, stat):
+    return pd.read_csv(path)
+
+# --- Route graph caching: only rebuilt when a barge's stop sequence changes ---
+@st.cache_data
+def build_route_graph(site_ids: tuple):
+    stops = ['PORT0'] + list(site_ids)
+    G = nx.DiGraph()
+    G.add_edges_from(zip(stops, stops[1:] + ['PORT0']))
+    pos = {site: (i, i % 2) for i, site in enumerate(stops)}
+    return G, pos
+
 # --- Run pipeline ---
 if st.button("Run Forecast & Optimize"):
 
     # --- Forecast ---
     with st.spinner("Generating forecasts..."):
-        forecast_df = generate_forecast()
+        sales_stat = file_stat(INPUT_SALES)
+        cache_state = forecast_cache_state()
+        if cache_state.get('sales_stat') not in (None, sales_stat):
+            generate_forecast.clear()  # stale versions can never be hit again
+        cache_state['sales_stat'] = sales_stat
+        forecast_df = generate_forecast(sales_stat)
         st.success("Forecast complete!")
 
     st.subheader("Forecast Table")
@@ -50,10 +83,25 @@ if st.button("Run Forecast & Optimize"):
 
     # --- Optimization ---
     with st.spinner("Running optimizer..."):
-        optimizer = Optimizer(forecast_df, SITE_SPECS, TRAVEL, BARGE)
+        # One Optimizer per session: its travel pivot, time-matrix memo and warm-start routes
+        # survive reruns, and only the forecast is swapped in for the selected week.
+        # It is rebuilt whenever one of the spec CSVs changes on disk.
+        input_stats = tuple(file_stat(path) for path in (SITE_SPECS, TRAVEL, BARGE))
+        optimizer = st.session_state.get('optimizer')
+        if optimizer is None or st.session_state.get('optimizer_inputs') != input_stats:
+            optimizer = Optimizer(forecast_df,
+                                  load_csv(SITE_SPECS, input_stats[0]),
+                                  load_csv(TRAVEL, input_stats[1]),
+                                  load_csv(BARGE, input_stats[2]))
+            st.session_state['optimizer'] = optimizer
+            st.session_state['optimizer_inputs'] = input_stats
+        else:
+            optimizer.set_forecast(forecast_df)
         route_dict = optimizer.run(week_start_date=str(week_start))
 
     st.success("Optimization complete!")
+    if optimizer.dropped_sites:
+        st.warning("Sites left unserved this week (capacity/time windows): " + ", ".join(optimizer.dropped_sites))
 
     if route_dict:
         # --- Flatten dictionary into DataFrame ---
@@ -64,8 +112,9 @@ if st.button("Run Forecast & Optimize"):
         df_route = pd.DataFrame(route_rows)
 
         if not df_route.empty:
-            df_route['cumulative_qty'] = df_route.groupby('barge_id')['qty'].cumsum()
-            df_route['visit_order'] = df_route.groupby('barge_id')['order'].rank(method='first').astype(int)
+            # Stops are already listed in visit order within each barge
+            df_route['cumulative_qty'] = df_route.groupby('barge_id', sort=False)['qty'].cumsum()
+            df_route['visit_order'] = df_route.groupby('barge_id', sort=False).cumcount() + 1
 
             df_route['arrival_dt'] = df_route['arrival_dt'].dt.strftime('%Y-%m-%d %H:%M')
             df_route['departure_dt'] = df_route['departure_dt'].dt.strftime('%Y-%m-%d %H:%M')
@@ -92,16 +141,12 @@ if st.button("Run Forecast & Optimize"):
             # --- Draw per-barge route maps ---
             for barge_id, stops in df_route.groupby('barge_id'):
                 st.subheader(f"Barge {barge_id} Route Map")
-                G = nx.DiGraph()
                 if len(stops) > 0:
-                    edges = [('PORT0', stops.iloc[0]['site_id'])] + \
-                            [(stops.iloc[i]['site_id'], stops.iloc[i+1]['site_id']) for i in range(len(stops)-1)] + \
-                            [(stops.iloc[-1]['site_id'], 'PORT0')]
-                    G.add_edges_from(edges)
-                    pos = {site: (i, i % 2) for i, site in enumerate(['PORT0'] + list(stops['site_id']))}
-                    plt.figure(figsize=(8, 4))
-                    nx.draw(G, pos, with_labels=True, node_size=1000, node_color='skyblue', arrows=True)
-                    st.pyplot(plt.gcf())
+                    G, pos = build_route_graph(tuple(stops['site_id']))
+                    fig, ax = plt.subplots(figsize=(8, 4))
+                    nx.draw(G, pos, ax=ax, with_labels=True, node_size=1000, node_color='skyblue', arrows=True)
+                    st.pyplot(fig)
+                    plt.close(fig)  # release the figure; pyplot otherwise keeps every rerun's figures alive
         else:
             st.warning("No feasible stops for any barge this week.")
     else:
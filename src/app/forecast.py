@@ -2,9 +2,147 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from joblib import Parallel, delayed, parallel_config
 from statsmodels.tsa.holtwinters import ExponentialSmoothing
 from statsmodels.tsa.arima.model import ARIMA
 
+SEASONAL_PERIODS = 52  # weekly data, yearly seasonality
+
+def _backtest_rmse(actual: pd.Series | None, predicted: pd.Series) -> float:
+    """
+    RMSE of the first len(actual) predicted weeks against the holdout actuals.
+    """
+    if actual is None:
+        return np.inf
+    return np.sqrt(((actual - predicted.iloc[:len(actual)])**2).mean())
+
+
+def _fit_ets(train: pd.Series, h: int, steps: int, actual: pd.Series | None,
+             fallback: pd.Series) -> tuple[pd.Series, float]:
+    """
+    Fits an additive Holt-Winters model and returns its h-week forecast and backtest RMSE.
+    Falls back to the given forecast with infinite error when the fit fails.
+    """
+    try:
+        ets_model = ExponentialSmoothing(
+            train,
+            trend='add',
+            seasonal='add',
+            seasonal_periods=SEASONAL_PERIODS
+        ).fit(optimized=True)
+        ets_all = ets_model.forecast(steps)
+        return ets_all.iloc[:h], _backtest_rmse(actual, ets_all)
+    except Exception as ex:
+        print("ETS failed:", ex)
+        return fallback, np.inf
+
+
+def _fit_arima(train: pd.Series, h: int, steps: int, actual: pd.Series | None,
+               fallback: pd.Series) -> tuple[pd.Series, float]:
+    """
+    Fits an ARIMA(1,1,1) model and returns its h-week forecast and backtest RMSE.
+    Falls back to the given forecast with infinite error when the fit fails.
+    """
+    try:
+        if len(train) < 5:  # require enough points
+            raise ValueError("Not enough data for ARIMA")
+        ar_model = ARIMA(train, order=(1,1,1))
+        ar_fit = ar_model.fit()
+        ar_all = ar_fit.get_forecast(steps).predicted_mean
+        return ar_all.iloc[:h], _backtest_rmse(actual, ar_all)
+    except Exception as ex:
+        print("ARIMA failed:", ex)
+        return fallback, np.inf
+
+
+def _fit_and_forecast(series: pd.Series, h: int, holdout_weeks: int,
+                      target_week: pd.Timestamp | None = None) -> tuple[pd.Series, str]:
+    """
+    Fits ETS and ARIMA models on a time series and selects the best based on backtest RMSE.
+    Handles small series, missing weeks, and ensures realistic forecasts.
+
+    Args:
+        series (pd.Series): Weekly units sold, indexed by week_start datetime.
+        h (int): Forecast horizon (number of weeks).
+        holdout_weeks (int): Number of weeks reserved for model backtesting.
+        target_week (pd.Timestamp, optional): If given, shortens h so the forecast
+            runs just far enough to cover this week (never beyond h).
+
+    Returns:
+        forecast (pd.Series): Forecasted weekly units (non-negative integers).
+        method (str): Model used ('ETS', 'ARIMA', 'MEAN', 'ZERO' or 'CONST').
+    """
+    n = len(series)
+    # Fill missing weeks with linear interpolation
+    ts = series.asfreq('7D').interpolate(method='linear').fillna(method='bfill')
+
+    train_len = max(3, n - holdout_weeks)  # ensure minimum training length
+    train = ts.iloc[:train_len]
+
+    if target_week is not None:
+        h = min(h, max(1, int(np.ceil((target_week - train.index[-1]).days / 7))))
+
+    # Both the horizon forecast and the backtest start at the end of train,
+    # so predict once over the longer span and slice.
+    steps = max(h, holdout_weeks)
+    fore_index = pd.date_range(train.index[-1] + pd.Timedelta(7, 'd'), periods=h, freq='7D')
+
+    # Flat series give the optimizers nothing to fit; answer them without statsmodels
+    arr = ts.to_numpy()
+    if not arr.any():
+        return pd.Series(0, index=fore_index, dtype=int), 'ZERO'
+    if np.ptp(arr) == 0:
+        return pd.Series(max(0, int(round(arr[0]))), index=fore_index, dtype=int), 'CONST'
+
+    mean_fore = pd.Series(np.repeat(train.mean(), h), index=fore_index)
+
+    # If series is too short, use simple trend or mean
+    #if n < 10:
+    #    mean_val = max(0, int(round(train.mean())))
+    #    forecast = pd.Series([mean_val] * h,
+    #                         index=pd.date_range(train.index[-1] + pd.Timedelta(7, 'd'),
+    #                                             periods=h, freq='7D'))
+    #    return forecast, "Simple"
+
+    # --- Fit candidate models ---
+    # Holdout actuals for the backtest; without enough history the models cannot be scored
+    actual = ts.iloc[-holdout_weeks:] if n > holdout_weeks else None
+
+    # Seasonal ETS cannot be initialised from less than two full cycles, so skip the fit
+    fit_ets = len(train) >= 2 * SEASONAL_PERIODS
+    ets_fore, ets_err = mean_fore, np.inf
+    if fit_ets:
+        ets_fore, ets_err = _fit_ets(train, h, steps, actual, mean_fore)
+    ar_fore, ar_err = _fit_arima(train, h, steps, actual, mean_fore)
+
+    # --- Choose best model ---
+    if ar_err < ets_err:
+        chosen, method = ar_fore, 'ARIMA'
+    elif fit_ets:
+        chosen, method = ets_fore, 'ETS'
+    else:
+        chosen, method = mean_fore, 'MEAN'
+
+    # Ensure non-negative integers
+    chosen = chosen.clip(lower=0).round().astype(int)
+    return chosen, method
+
+
+def _fit_group(site: str, prod: str, series: pd.Series, h: int, holdout_weeks: int,
+               target_week: pd.Timestamp | None = None) -> pd.DataFrame:
+    """
+    Forecasts a single site-product series and returns its rows of the output table.
+    Runs inside a joblib worker, so it must stay a module-level (picklable) function.
+    """
+    forecast, method = _fit_and_forecast(series, h, holdout_weeks, target_week)
+    return pd.DataFrame({
+        'site_id': site,
+        'product_id': prod,
+        'week_start': pd.DatetimeIndex(forecast.index),
+        'forecast_units': forecast.to_numpy(dtype=np.int32),
+        'method': method
+    })
+
 
 class Forecast:
     """
@@ -15,137 +153,81 @@ class Forecast:
         - Fits baseline time-series models (ETS and ARIMA) for each site-product pair.
         - Backtests the models on a holdout period to select the best model.
         - Produces a user-specified horizon forecast with non-negative integer values.
-        - Saves a timestamped CSV of forecasts for traceability.
+        - Saves a timestamped Parquet file of forecasts for traceability.
+
+    Site-product pairs are independent, so their model fits are spread across
+    worker processes with joblib.
 
     Attributes:
         input_sales (str): Path to CSV file containing historical sales data with columns 
             ['site_id', 'product_id', 'date', 'units_sold'].
         holdout_weeks (int): Number of weeks reserved for model backtesting.
         forecast_horizon (int): Number of future weeks to forecast.
+        n_jobs (int): Number of worker processes for model fitting (-1 uses all cores).
     
     Methods:
-        run(): Executes the forecast for all site-product pairs and returns a DataFrame with columns:
+        run(target_week=None): Executes the forecast for all site-product pairs and returns a DataFrame with columns:
             ['site_id', 'product_id', 'week_start', 'forecast_units', 'method'].
+            With target_week set, each series is only forecast up to that week.
     """
 
-    def __init__(self, input_sales: str, holdout_weeks: int, forecast_horizon: int):
+    def __init__(self, input_sales: str, holdout_weeks: int, forecast_horizon: int, n_jobs: int = -1):
         self.input_sales = input_sales
         self.holdout_weeks = holdout_weeks
         self.forecast_horizon = forecast_horizon
+        self.n_jobs = n_jobs
 
     def __load_and_prep(self) -> pd.DataFrame:
         """
         Loads sales CSV, converts dates to ISO week starts (Mondays), 
         and aggregates units sold per week, site, and product.
         """
-        df = pd.read_csv(self.input_sales, parse_dates=['date'])
-        df['week_start'] = df['date'].dt.to_period('W').apply(lambda r: r.start_time)
-        weekly = df.groupby(['site_id', 'product_id', 'week_start'], as_index=False)['units_sold'].sum()
+        df = pd.read_csv(self.input_sales, engine='pyarrow', parse_dates=['date'])
+        # Blank units_sold cells count as no sales (groupby().sum() skipped them before the cast)
+        df['units_sold'] = df['units_sold'].fillna(0)
+        df = df.astype({'site_id': 'category', 'product_id': 'category', 'units_sold': 'int32'})
+        # Roll each date back to its Monday (vectorized; matches to_period('W').start_time)
+        df['week_start'] = df['date'].dt.normalize() - pd.to_timedelta(df['date'].dt.dayofweek, unit='D')
+        weekly = df.groupby(['site_id', 'product_id', 'week_start'], as_index=False, observed=True)['units_sold'].sum()
         return weekly
 
-    def __fit_and_forecast(self, series: pd.Series, h: int) -> tuple[pd.Series, str]:
+    def run(self, target_week: str | None = None) -> pd.DataFrame:
         """
-        Fits ETS and ARIMA models on a time series and selects the best based on backtest RMSE.
-        Handles small series, missing weeks, and ensures realistic forecasts.
+        Runs the forecasting pipeline for all site-product pairs.
 
         Args:
-            series (pd.Series): Weekly units sold, indexed by week_start datetime.
-            h (int): Forecast horizon (number of weeks).
-
-        Returns:
-            forecast (pd.Series): Forecasted weekly units (non-negative integers).
-            method (str): Model used ('ETS' or 'ARIMA').
-        """
-        n = len(series)
-        # Fill missing weeks with linear interpolation
-        ts = series.asfreq('7D').interpolate(method='linear').fillna(method='bfill')
-        
-        train_len = max(3, n - self.holdout_weeks)  # ensure minimum training length
-        train = ts.iloc[:train_len]
-
-        # If series is too short, use simple trend or mean
-        #if n < 10:
-        #    mean_val = max(0, int(round(train.mean())))
-        #    forecast = pd.Series([mean_val] * h,
-        #                         index=pd.date_range(train.index[-1] + pd.Timedelta(7, 'd'),
-        #                                             periods=h, freq='7D'))
-        #    return forecast, "Simple"
-
-        # --- ETS forecast ---
-        try:
-            ets_model = ExponentialSmoothing(
-                train,
-                trend='add',
-                seasonal='add',
-                seasonal_periods=52
-            ).fit(optimized=True)
-            ets_fore = ets_model.forecast(h)
-            ets_err = np.inf
-            if n > self.holdout_weeks:
-                backtest_fore = ets_model.forecast(self.holdout_weeks)
-                ets_err = np.sqrt(((ts.iloc[-self.holdout_weeks:] - backtest_fore)**2).mean())
-        except Exception as ex:
-            print("ETS failed:", ex)
-            ets_fore = pd.Series(np.repeat(train.mean(), h),
-                                index=pd.date_range(train.index[-1] + pd.Timedelta(7, 'd'),
-                                                    periods=h, freq='7D'))
-            ets_err = np.inf
-
-        # --- ARIMA forecast ---
-        try:
-            if len(train) >= 5:  # require enough points
-                ar_model = ARIMA(train, order=(1,1,1))
-                ar_fit = ar_model.fit()
-                ar_fore = ar_fit.get_forecast(h).predicted_mean
-                ar_err = np.inf
-                if n > self.holdout_weeks:
-                    backtest_fore = ar_fit.get_forecast(self.holdout_weeks).predicted_mean
-                    ar_err = np.sqrt(((ts.iloc[-self.holdout_weeks:] - backtest_fore)**2).mean())
-            else:
-                raise ValueError("Not enough data for ARIMA")
-        except Exception as ex:
-            print("ARIMA failed:", ex)
-            ar_fore = pd.Series(np.repeat(train.mean(), h),
-                                index=pd.date_range(train.index[-1] + pd.Timedelta(7, 'd'),
-                                                    periods=h, freq='7D'))
-            ar_err = np.inf
-
-        # --- Choose best model ---
-        if ar_err < ets_err:
-            chosen, method = ar_fore, 'ARIMA'
-        else:
-            chosen, method = ets_fore, 'ETS'
-
-        # Ensure non-negative integers
-        chosen = chosen.clip(lower=0).round().astype(int)
-        return chosen, method
-
-    def run(self) -> pd.DataFrame:
-        """
-        Runs the forecasting pipeline for all site-product pairs.
+            target_week (str, optional): Week start (YYYY-MM-DD) the caller needs. When set,
+                each series is forecast only up to that week (capped at forecast_horizon weeks).
+                The model fits cost the same either way, so this trims the output rather than
+                the run time. Leave unset for the full horizon.
+                The snapshot file name then carries the target week, so it does not
+                overwrite the day's full-horizon snapshot.
 
         Returns:
             pd.DataFrame: Forecast output with columns ['site_id', 'product_id', 
                                                        'week_start', 'forecast_units', 'method']
         """
         weekly = self.__load_and_prep()
-        outputs = []
-
-        for (site, prod), group in weekly.groupby(['site_id', 'product_id']):
-            ts = group.set_index('week_start')['units_sold'].asfreq('7D').fillna(0)
-            forecast, method = self.__fit_and_forecast(ts, self.forecast_horizon)
-            for week_start, val in forecast.items():
-                outputs.append({
-                    'site_id': site,
-                    'product_id': prod,
-                    'week_start': pd.to_datetime(week_start),
-                    'forecast_units': int(val),
-                    'method': method
-                })
-
-        outdf = pd.DataFrame(outputs)
+        target = pd.Timestamp(target_week) if target_week is not None else None
+
+        # One BLAS/OpenMP thread per worker: the parallelism is across series,
+        # and nested thread pools would oversubscribe the cores.
+        with parallel_config(backend='loky', inner_max_num_threads=1):
+            parts = Parallel(n_jobs=self.n_jobs)(
+                delayed(_fit_group)(
+                    site, prod,
+                    group.set_index('week_start')['units_sold'].asfreq('7D').fillna(0),
+                    self.forecast_horizon, self.holdout_weeks, target
+                )
+                for (site, prod), group in weekly.groupby(['site_id', 'product_id'], observed=True)
+            )
+
+        outdf = pd.concat(parts, ignore_index=True, copy=False)
         stamp = datetime.now().strftime("%Y%m%d")
-        outpath = f"outputs/forecasts_v{stamp}.csv"
-        outdf.to_csv(outpath, index=False)
+        suffix = f"_to{target:%Y%m%d}" if target is not None else ""
+        outpath = f"outputs/forecasts_v{stamp}{suffix}.parquet"
+        outdf.astype({'site_id': 'category', 'product_id': 'category', 'method': 'category'}).to_parquet(
+            outpath, engine='pyarrow', compression='zstd', index=False
+        )
         print("Forecasts written to:", outpath)
         return outdf
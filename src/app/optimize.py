@@ -1,36 +1,103 @@
 # optimize.py
 import pandas as pd
+import numpy as np
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 from datetime import datetime
-import math
+
+
+def _hhmm_to_minutes(col: pd.Series) -> np.ndarray:
+    """
+    Converts a column of 'HH:MM' strings to minutes after midnight ('24:00' is allowed).
+    """
+    parts = col.str.split(':', expand=True).astype(np.int32)
+    return (parts[0]*60 + parts[1]).to_numpy()
+
+
+def _clamp_windows(windows: list[tuple], horizon: int) -> tuple[list[int], list[int]]:
+    """
+    Rounds (open, close) minute windows and clamps them to [0, horizon], keeping each window
+    at least one minute wide. Returns the opens and closes as plain int lists for SetRange.
+    """
+    w = np.round(np.asarray(windows, dtype=np.float64).reshape(-1, 2)).astype(np.int64)
+    w0 = np.maximum(w[:, 0], 0)
+    w1 = np.minimum(w[:, 1], horizon)
+    w1 = np.where(w1 <= w0, w0 + 1, w1)
+    return w0.tolist(), w1.tolist()
+
 
 class Optimizer:
     """
     Optimizer for weekly dispatch planning using CVRPTW (Capacitated Vehicle Routing Problem with Time Windows).
 
     Attributes:
-        forecast_df (pd.DataFrame): Forecasted weekly demand with columns ['site_id', 'week_start', 'forecast_units'].
-        site_specs_file (str): Path to CSV with site specifications (open/close times, service times, etc.).
-        travel_file (str): Path to CSV with travel times between sites.
-        barge_file (str): Path to CSV with barge specifications (capacity, working hours, loading rate).
+        forecast_df (pd.DataFrame): Forecasted weekly demand with columns ['site_id', 'week_start', 'forecast_units'];
+            week_start must already be datetime64 (as produced by Forecast.run); a TypeError is raised otherwise.
+        site_specs_file (str | pd.DataFrame): CSV path or DataFrame with site specifications (open/close times, service times, etc.).
+        travel_file (str | pd.DataFrame): CSV path or DataFrame with travel times between sites.
+        barge_file (str | pd.DataFrame): CSV path or DataFrame with barge specifications (capacity, working hours, loading rate).
+        metaheuristic (str): OR-Tools LocalSearchMetaheuristic name used after the first solution
+            (e.g. 'GUIDED_LOCAL_SEARCH', 'TABU_SEARCH', 'GENERIC_TABU_SEARCH'); unknown names raise ValueError.
+        dropped_sites (list[str]): Sites with demand that the last run() could not serve (capacity/time windows).
 
     Methods:
-        run(week_start): Generates a dispatch route for the specified week_start date.
+        run(week_start, verbose=False): Generates a dispatch route for the specified week_start date.
+        set_forecast(forecast_df): Swaps in a new forecast, keeping the travel-time caches and warm start.
     """
 
-    def __init__(self, forecast_df, site_specs_file, travel_file, barge_file):
-        self.forecast_df = forecast_df
+    def __init__(self, forecast_df, site_specs_file, travel_file, barge_file, metaheuristic='GUIDED_LOCAL_SEARCH'):
+        self.set_forecast(forecast_df)
         self.site_specs_file = site_specs_file
         self.travel_file = travel_file
         self.barge_file = barge_file
+        self.metaheuristic = metaheuristic
+        self._metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.Value.Value(metaheuristic)
+
+        # Inputs are parsed once here and shared by every run
+        self._sites = self.__load_table(site_specs_file).set_index('site_id')  # indexed for per-week lookups
+        self._tt = self.__load_table(travel_file)
+        self._barges = self.__load_table(barge_file)
+        # from_site x to_site travel pivot (first listed edge wins on duplicates, missing edges NaN)
+        self._tt_matrix = (
+            self._tt.drop_duplicates(['from_site', 'to_site'])
+                    .pivot(index='from_site', columns='to_site', values='travel_minutes')
+        )
+        self._tt_edges = set(zip(self._tt['from_site'], self._tt['to_site']))
+        self._time_matrices = {}  # node tuple -> time matrix aligned to that node order
+        self._last_solution_routes = {}  # barge_id -> site_ids of the last solved week, used as a warm start
+        self.dropped_sites = []
+
+    def set_forecast(self, forecast_df):
+        """
+        Replace the forecast used by later runs. Site, travel and barge inputs, the time-matrix
+        memo and the warm-start routes are kept, so a long-lived Optimizer can be fed a new
+        forecast (e.g. one per selected week) without rebuilding them.
+        """
+        if not pd.api.types.is_datetime64_any_dtype(forecast_df['week_start']):
+            raise TypeError("forecast_df['week_start'] must be datetime64; parse it before building the Optimizer")
+        self.forecast_df = forecast_df
+        # Forecast rows indexed by (midnight) week start, sorted so a week is a slice lookup;
+        # site_id as category so the per-week demand groupby hashes integer codes
+        self._forecast_by_week = (
+            forecast_df.astype({'site_id': 'category'})
+                .set_index(forecast_df['week_start'].dt.normalize())
+                .sort_index()
+        )
+
+    def __load_table(self, source):
+        """
+        Return source as a DataFrame, reading it from CSV when given a path.
+        """
+        if isinstance(source, pd.DataFrame):
+            return source
+        return pd.read_csv(source)
 
     def __minutes_to_datetime(self, week_start_date, minutes):
         """
-        Convert minutes since week start into a pandas.Timestamp
+        Convert a sequence of minutes since week start into pandas.Timestamps (one DatetimeIndex)
         """
         start_week = pd.to_datetime(week_start_date)
-        return start_week + pd.Timedelta(minutes=minutes)
+        return start_week + pd.to_timedelta(np.asarray(minutes), unit='m')
 
     def __build_week_input(self, week_start_date):
         """
@@ -40,94 +107,86 @@ class Optimizer:
             df_nodes (pd.DataFrame): Sites with forecasted demand and service info.
             tt_df (pd.DataFrame): Travel times between sites.
         """
-        target_date = pd.to_datetime(week_start_date)
-        self.forecast_df['week_start'] = pd.to_datetime(self.forecast_df['week_start'], errors='coerce')
+        target_date = pd.to_datetime(week_start_date).normalize()
 
-        # Filter forecast for this week
-        week = self.forecast_df[self.forecast_df['week_start'].dt.date == target_date.date()]
+        # Select this week's forecast rows
+        week = self._forecast_by_week.loc[target_date:target_date]
         if week.empty:
             print(f"No forecast rows for week_start {target_date.date()}")
             return pd.DataFrame(), pd.DataFrame()
 
-        # Aggregate demand per site
-        demand = week.groupby('site_id')['forecast_units'].sum().reset_index()
-
-        # Load site specs and ensure depot exists
-        sites = pd.read_csv(self.site_specs_file)
-        if 'PORT0' not in sites['site_id'].values:
-            depot_row = {'site_id': 'PORT0', 'lat': None, 'lon': None,
-                         'open_time': '00:00', 'close_time': '23:59',
-                         'service_time_minutes': 0, 'max_visit_volume_units': 0}
-            sites = pd.concat([pd.DataFrame([depot_row]), sites], ignore_index=True)
+        # Aggregate demand per site; sites with nothing to deliver stay out of the routing model
+        demand = week.groupby('site_id', observed=True)['forecast_units'].sum().reset_index()
+        demand = demand[demand['forecast_units'] > 0]
+        if demand.empty:
+            print(f"No positive demand for week_start {target_date.date()}")
+            return pd.DataFrame(), pd.DataFrame()
 
-        df_nodes = pd.merge(sites, demand, on='site_id', how='right').fillna(0)
+        # Site specs for the demand sites; the depot is implicit node 0 in __create_data_model
+        df_nodes = (
+            self._sites.reindex(demand['site_id'].astype(object))  # plain labels, not categorical
+                .assign(forecast_units=demand['forecast_units'].to_numpy())
+                .reset_index()
+                .fillna(0)
+        )
 
-        # Load travel times
-        tt_df = pd.read_csv(self.travel_file)
+        # Travel times
+        tt_df = self._tt
 
         # Check for missing travel edges
+        edges = self._tt_edges
         missing_edges = []
         for site in df_nodes['site_id']:
             if site == 'PORT0':
                 continue
-            if not ((tt_df['from_site'] == 'PORT0') & (tt_df['to_site'] == site)).any():
+            if ('PORT0', site) not in edges:
                 missing_edges.append(f"PORT0->{site}")
-            if not ((tt_df['from_site'] == site) & (tt_df['to_site'] == 'PORT0')).any():
+            if (site, 'PORT0') not in edges:
                 missing_edges.append(f"{site}->PORT0")
         if missing_edges:
             print("Warning: missing travel-time edges:", missing_edges)
 
         return df_nodes, tt_df
 
-    def __create_data_model(self, df_nodes, tt_df, barge_df, depot_id='PORT0'):
+    def __create_data_model(self, df_nodes, barge_df, depot_id='PORT0'):
         nodes = [depot_id] + df_nodes['site_id'].tolist()
         n = len(nodes)
 
-        # Time matrix
-        time_matrix = [[0]*n for _ in range(n)]
-        for i, ni in enumerate(nodes):
-            for j, nj in enumerate(nodes):
-                if i == j:
-                    time_matrix[i][j] = 0
-                else:
-                    row = tt_df[(tt_df['from_site']==ni) & (tt_df['to_site']==nj)]
-                    time_matrix[i][j] = int(row['travel_minutes'].iloc[0]) if not row.empty else 9999
+        # Time matrix: align the travel pivot to this node order (missing edges get 9999),
+        # reusing the result when a later week visits the same sites
+        time_matrix = self._time_matrices.get(tuple(nodes))
+        if time_matrix is None:
+            # C-contiguous int32 (to_numpy hands back the frame's column-major block)
+            time_matrix = np.ascontiguousarray(
+                self._tt_matrix
+                    .reindex(index=nodes, columns=nodes)
+                    .fillna(9999)
+                    .to_numpy(dtype=np.int32)
+            )
+            np.fill_diagonal(time_matrix, 0)
+            self._time_matrices[tuple(nodes)] = time_matrix
 
         # Demands & service times
-        demands = [0] + df_nodes['forecast_units'].astype(int).tolist()
-        service_times = [0] # + df_nodes['service_time_minutes'].fillna(30).astype(int).tolist()
-
-        # Iterate through sites and compute service time per stop
-        for idx, row in df_nodes.iterrows():
-            # Use forecast demand
-            qty = row['forecast_units']
-            
-            # Get barge loading rate - here we can use the max or average rate
-            # For simplicity, assume first barge's rate
-            loading_rate = barge_df['avg_loading_rate_units_per_min'].iloc[0]  # adjust per barge if needed
-            
-            # Compute service time = max(site_min_service_time, ceil(qty / loading_rate))
-            site_min = row['service_time_minutes'] if not math.isnan(row['service_time_minutes']) else 30
-            service_time = max(site_min, math.ceil(qty / loading_rate))
-            
-            service_times.append(service_time)
-
-        def to_min(tstr):
-            hh, mm = map(int, tstr.split(':'))
-            return hh*60 + mm
+        demands = [0] + df_nodes['forecast_units'].to_numpy(dtype=np.int32).tolist()
+
+        # Service time per stop = max(site_min_service_time, ceil(qty / loading_rate)),
+        # using the first barge's loading rate for every stop (adjust per barge if needed)
+        loading_rate = float(barge_df['avg_loading_rate_units_per_min'].iloc[0])
+        qty = df_nodes['forecast_units'].to_numpy()
+        site_min = df_nodes['service_time_minutes'].fillna(30).to_numpy()
+        service_times = [0] + np.maximum(site_min, np.ceil(qty / loading_rate)).astype(np.int64).tolist()
 
         # Time windows for sites
-        windows = [(0, 24*60)]  # depot open all day
-        for _, row in df_nodes.iterrows():
-            windows.append((to_min(row['open_time']), to_min(row['close_time'])))
+        opens = _hhmm_to_minutes(df_nodes['open_time']).tolist()
+        closes = _hhmm_to_minutes(df_nodes['close_time']).tolist()
+        windows = [(0, 24*60)] + list(zip(opens, closes))  # depot open all day
 
         # Vehicle capacities & working hours
-        vehicle_capacities = barge_df['total_capacity_units'].astype(int).tolist()
+        vehicle_capacities = barge_df['total_capacity_units'].to_numpy(dtype=np.int32).tolist()
         num_vehicles = len(vehicle_capacities)
 
-        vehicle_time_windows = []
-        for _, row in barge_df.iterrows():
-            vehicle_time_windows.append((to_min(row['working_hours_start']), to_min(row['working_hours_end'])))
+        vehicle_time_windows = list(zip(_hhmm_to_minutes(barge_df['working_hours_start']).tolist(),
+                                        _hhmm_to_minutes(barge_df['working_hours_end']).tolist()))
 
         return {
             'time_matrix': time_matrix,
@@ -143,10 +202,11 @@ class Optimizer:
         }
 
 
-    def __solve_cvrptw(self,week_start_date, data):
+    def __solve_cvrptw(self,week_start_date, data, verbose=False):
         """
         Solve CVRPTW problem with OR-Tools and return route as a dictionary of barge_id -> stops.
         Handles vehicle time windows, node time windows, and capacity checks safely.
+        With verbose=True the solver logs every search improvement to stdout.
         """
         total_demand = sum(data['demands'])
         total_capacity = sum(data['vehicle_capacities'])
@@ -158,15 +218,18 @@ class Optimizer:
             data['num_vehicles'],
             data['depot']
         )
-        routing = pywrapcp.RoutingModel(manager)
-
-        # --- Transit callback: travel + service time ---
-        def time_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return int(data['time_matrix'][from_node][to_node]) + int(data['service_times'][from_node])
-
-        transit_idx = routing.RegisterTransitCallback(time_callback)
+        # All barges share one arc cost, so let the model collapse per-vehicle costs, and
+        # cache evaluator results (the threshold is a node count, so cover the whole model).
+        model_params = pywrapcp.DefaultRoutingModelParameters()
+        model_params.reduce_vehicle_cost_model = True
+        model_params.max_callback_cache_size = manager.GetNumberOfIndices()
+        routing = pywrapcp.RoutingModel(manager, model_params)
+
+        # --- Transit: travel + service time ---
+        # Registered as a matrix so arc evaluations stay inside the C++ solver
+        # instead of calling back into Python for every arc.
+        transit = data['time_matrix'] + np.asarray(data['service_times'], dtype=np.int32)[:, None]
+        transit_idx = routing.RegisterTransitMatrix(transit.tolist())
         routing.SetArcCostEvaluatorOfAllVehicles(transit_idx)
 
         # --- Time dimension ---
@@ -181,18 +244,12 @@ class Optimizer:
         time_dim = routing.GetDimensionOrDie('Time')
 
         # --- Node time windows (clamped to horizon) ---
-        for idx, (w0, w1) in enumerate(data['time_windows']):
-            index = manager.NodeToIndex(idx)
-            w0 = max(0, int(round(w0)))
-            w1 = min(horizon, int(round(w1)))
-            if w1 <= w0:
-                w1 = w0 + 1
-            time_dim.CumulVar(index).SetRange(w0, w1)
+        opens, closes = _clamp_windows(data['time_windows'], horizon)
+        for idx, (w0, w1) in enumerate(zip(opens, closes)):
+            time_dim.CumulVar(manager.NodeToIndex(idx)).SetRange(w0, w1)
 
         # --- Vehicle capacity dimension ---
-        def demand_callback(from_index):
-            return int(data['demands'][manager.IndexToNode(from_index)])
-        demand_idx = routing.RegisterUnaryTransitCallback(demand_callback)
+        demand_idx = routing.RegisterUnaryTransitVector(data['demands'])
         routing.AddDimensionWithVehicleCapacity(
             demand_idx,
             slack_max=0,
@@ -201,26 +258,49 @@ class Optimizer:
             name='Capacity'
         )
 
-        # --- Vehicle working hours ---
-        for vid in range(data['num_vehicles']):
-            start_var = time_dim.CumulVar(routing.Start(vid))
-            end_var = time_dim.CumulVar(routing.End(vid))
-            w0, w1 = data.get('vehicle_time_windows', [(0, 24*60)]*data['num_vehicles'])[vid]
+        # --- Optional visits ---
+        # A site may be left out, but the penalty exceeds the cost of any feasible plan
+        # (every route fits in the horizon), so sites are only dropped when they cannot
+        # be served at all instead of the whole solve failing.
+        drop_penalty = horizon * data['num_vehicles'] + 1
+        for node in range(1, len(data['nodes'])):
+            routing.AddDisjunction([manager.NodeToIndex(node)], drop_penalty)
 
-            w0 = max(0, int(round(w0)))
-            w1 = max(w0 + 1, int(round(w1)))  # ensure w1 > w0
-            start_var.SetRange(w0, w1)
-            end_var.SetRange(w0, w1)
+        # --- Vehicle working hours ---
+        starts, ends = _clamp_windows(
+            data.get('vehicle_time_windows', [(0, 24*60)]*data['num_vehicles']), horizon)
+        for vid, (w0, w1) in enumerate(zip(starts, ends)):
+            time_dim.CumulVar(routing.Start(vid)).SetRange(w0, w1)
+            time_dim.CumulVar(routing.End(vid)).SetRange(w0, w1)
 
         # --- Solver parameters ---
         params = pywrapcp.DefaultRoutingSearchParameters()
-        params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.SAVINGS #routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-        params.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+        params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION #routing_enums_pb2.FirstSolutionStrategy.SAVINGS
+        params.local_search_metaheuristic = self._metaheuristic
         params.time_limit.seconds = 60
-        params.log_search = True
+        params.solution_limit = 1_000_000
+        params.lns_time_limit.seconds = 2  # per-neighborhood budget for LNS operators
+        params.log_search = verbose
+
+        # --- Warm start from the previous week's routes ---
+        # Sites not visited this week are filtered out; if the seeded routes are infeasible
+        # (capacity/time windows) OR-Tools returns None and we solve from scratch.
+        initial = None
+        if self._last_solution_routes:
+            node_of = {site: node for node, site in enumerate(data['nodes']) if node != data['depot']}
+            initial_routes = [
+                [node_of[site] for site in self._last_solution_routes.get(barge_id, []) if site in node_of]
+                for barge_id in data['barge_ids']
+            ]
+            if any(initial_routes):
+                routing.CloseModelWithParameters(params)
+                initial = routing.ReadAssignmentFromRoutes(initial_routes, True)
 
         print("Starting solver...")
-        solution = routing.SolveWithParameters(params)
+        if initial is not None:
+            solution = routing.SolveFromAssignmentWithParameters(initial, params)
+        else:
+            solution = routing.SolveWithParameters(params)
 
         status_map = {
             0: "ROUTING_NOT_SOLVED",
@@ -245,13 +325,26 @@ class Optimizer:
                             'site_id': data['nodes'][node],
                             'qty': data['demands'][node],
                             'arrival_min': arrival_min,
-                            'departure_min': departure_min,
-                            'arrival_dt': self.__minutes_to_datetime(week_start_date, arrival_min),
-                            'departure_dt': self.__minutes_to_datetime(week_start_date, departure_min)
-               
+                            'departure_min': departure_min
                         })
                         order += 1
                     index = solution.Value(routing.NextVar(index))
+
+            # Timestamps for all stops in one vectorized conversion
+            stops = [stop for barge_stops in route.values() for stop in barge_stops]
+            if stops:
+                arrivals = self.__minutes_to_datetime(week_start_date, [s['arrival_min'] for s in stops])
+                departures = self.__minutes_to_datetime(week_start_date, [s['departure_min'] for s in stops])
+                for stop, arrival_dt, departure_dt in zip(stops, arrivals, departures):
+                    stop['arrival_dt'] = arrival_dt
+                    stop['departure_dt'] = departure_dt
+            dropped = [data['nodes'][node] for node in range(1, len(data['nodes']))
+                       if solution.Value(routing.NextVar(manager.NodeToIndex(node))) == manager.NodeToIndex(node)]
+            if dropped:
+                print("Warning: sites left unserved (capacity/time windows):", dropped)
+            self.dropped_sites = dropped
+            self._last_solution_routes = {barge_id: [stop['site_id'] for stop in stops]
+                                          for barge_id, stops in route.items()}
             print("Solver found a solution.")
             return route
         else:
@@ -262,18 +355,21 @@ class Optimizer:
 
 
 
-    def run(self, week_start_date='2025-10-13'):
+    def run(self, week_start_date='2025-10-13', verbose=False):
         """
         Run optimizer for a given week_start and return the dispatch routes for all barges.
+        Set verbose=True to print the OR-Tools search log (slows the solver down).
+        Sites the solver had to leave out are listed in self.dropped_sites afterwards.
         """
+        self.dropped_sites = []
         df_nodes, tt_df = self.__build_week_input(week_start_date)
         if df_nodes.empty or tt_df.empty:
             print("No data to solve for this week.")
             return None
 
-        barge_df = pd.read_csv(self.barge_file)
-        data = self.__create_data_model(df_nodes, tt_df, barge_df)
-        sol = self.__solve_cvrptw(week_start_date, data)
+        barge_df = self._barges
+        data = self.__create_data_model(df_nodes, barge_df)
+        sol = self.__solve_cvrptw(week_start_date, data, verbose)
 
         print("Solution route:", sol)
         return sol